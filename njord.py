@@ -3,14 +3,26 @@ import argparse
 import os, signal
 import re
 import requests
+import sqlite3
 import sys
+import threading
 import time
 import traceback
+import xml.etree.ElementTree as ET
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
 from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.firefox.options import Options as FirefoxOptions
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
+from urllib.parse import urljoin, urlsplit, urlunsplit
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+from urllib3.util.retry import Retry
 
 # Prerequisites
 # install python3-venv
@@ -30,6 +42,13 @@ exitCode = 0
 # Initialize the first error var. It serves to decide whether to print an issue header or not. See the printNOK() function for details.
 firstError = True
 
+# Argument type for the regular expression arguments. re.error isn't a ValueError, so argparse wouldn't turn it into a usage error by itself.
+def regexArg(pattern):
+    try:
+        return re.compile(pattern)
+    except re.error as err:
+        raise argparse.ArgumentTypeError("invalid regular expression '" + pattern + "': " + str(err))
+
 # Set up named arguments
 parser=argparse.ArgumentParser()
 parser.add_argument('-d', '--domain', help='Base URL of your portal, including the protocol, e.g. https://docs.example.org', required=True)
@@ -37,6 +56,10 @@ parser.add_argument('-f', '--folder', help='Folder (subportal) on your website,
 parser.add_argument('-x', '--no-external', help="Do not check external pages (ie. pages outside the domain)", required=False, action='store_true')
 parser.add_argument('-s', '--sitemap', help='Specify sitemap URL manually. Useful for checking only a portion of the portal using the --domain argument. Use full URL.', required=False, default="")
 parser.add_argument('-q', '--quiet', help='Do not print warnings, only info and errors.', required=False, action='store_true')
+parser.add_argument('-w', '--workers', help='Number of workers (each with its own headless Firefox, if needed) getting the pages from the sitemap and the outside pages of anchor links in parallel (default: 4).', required=False, type=int, default=4)
+parser.add_argument('-b', '--browser-only', help='Get all the pages from the sitemap with the headless Firefox. By default, pages are got by plain HTTP requests and only pages that look JS-generated are rendered in the browser.', required=False, action='store_true')
+parser.add_argument('-j', '--js-pages', help='Regular expression matching URLs of pages that are known to be JS-generated, e.g. "/reference/". These pages are always got with the headless Firefox, without trying a plain HTTP request first.', required=False, type=regexArg, default=None)
+parser.add_argument('-c', '--cache', help='Use the cache of the links found OK in the previous runs (.njord_cache.sqlite in the current directory): links found OK within the last 24 hours are not checked again. Off by default -- a link that broke meanwhile is reported as OK.', required=False, action='store_true')
 parser.add_argument('-v', '--verbose', help='Be very verbose and print time spent on each (larger) operation. Warning: The function of this debugging switch is not actively maintained.', required=False, action='store_true')
 
 # Store the arguments' values
@@ -47,6 +70,10 @@ manualSitemapLoc = args.sitemap
 noExternal = args.no_external
 beQuiet = args.quiet
 beVerbose = args.verbose
+crawlWorkers = max(1, args.workers)
+browserOnly = args.browser_only
+JSPagesRegex = args.js_pages
+useCache = args.cache
 
 # Domain and folder parameters cleanup:
 #    If domain doesn't start with HTTP(S) protocol, add it:
@@ -74,6 +101,68 @@ else:
 # Oftentimes, it's easier to work with the whole path.
 URLPath = domain + folder
 
+# Precompiled regexes used in the loops over the pages and links.
+#     The re module caches compiled patterns, but the patterns were still looked up in the cache on every call.
+#     Fixed-prefix checks (like '#', '../', the domain or the URL path) don't need a regex at all, str.startswith() is used for them. (It also doesn't need escaping the dots in the domain.)
+titleRegex = re.compile(r'<title[^>]*>(.*?)</title>', re.DOTALL)
+#     The attribute values may be double-quoted, single-quoted or unquoted. (The source rendered by the browser has all of them double-quoted, but the raw HTML got by plain HTTP requests has them as the author wrote them.)
+#     Each quoting has its own group, so use findAttrValues() instead of findall() to get the values.
+anchorLinkRegex = re.compile(r'''href\s*=\s*(?:"([^"#]*#[^"]+)"|'([^'#]*#[^']+)'|([^\s"'=<>`#]*#[^\s"'=<>`]+))''')
+normalLinkRegex = re.compile(r'''<a [^>]*?href\s*=\s*(?:"([^"#]+)"|'([^'#]+)'|([^\s"'=<>`#]+)(?=[\s>]))''')
+anchorAttrRegex = re.compile(r'''\b(?:name|id)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+))''')
+
+# Function that returns the attribute values matched by one of the regexes above. Only the group of the quoting that matched is non-empty, so the groups are simply joined.
+def findAttrValues(regex, document):
+    return [''.join(groups) for groups in regex.findall(document)]
+#     Anchor links that aren't checked (see the anchor links clean-up in the main loop for details): the beginnings of the links (str.startswith() takes them all at once) and a part anywhere in the link
+anchorBlacklistPrefixes = ('https://app.diagrams.net', 'https://app.getpostman.com/run-collection', 'https://learning.postman.com/', 'https://viewer.diagrams.net')
+anchorBlacklistPart = '/misc/satisfaction-levels'
+#     Normal links that aren't checked (see isSkippedLink() for details)
+#         Host of the link -> beginnings of the paths skipped on the host ('' skips the whole host)
+skippedLinkHosts = {
+    '127.0.0.1': ('',),
+    'azure.microsoft.com': ('/en-us',),
+    'business.adobe.com': ('/products/target',),
+    'csrc.nist.gov': ('/Projects/key-management/key-management-guidelines',),
+    'docs.oasis-open.org': ('/xliff/xliff-core',),
+    'fonts.cdnfonts.com': ('/css',),
+    'github.com': ('/Evolveum/docs/blob/',),
+    'graphiql-online.com': ('',),
+    'help.zapier.com': ('/hc/en-us/articles',),
+    'localhost': ('',),
+    'player.vimeo.com': ('/video/',),
+    'twitter.com': ('',),
+    'www.cloudflare.com': ('/learning',),
+    'www.dta.gov.au': ('',),
+    'www.mozilla.org': ('/firefox',),
+    'www.vic.gov.au': ('',),
+}
+#         Plain strings matched anywhere in the link (a substring test is cheaper than running a regex for a literal)
+skippedLinkParts = ('%7B', 'example.com', 'example.org', 'file-name', 'file_name', 'filename')
+#         Endings of the link
+skippedLinkEndings = ('woff', 'woff2')
+#     Markers of a JS-generated page skeleton (an empty application root element) in the raw HTML, see fetchPage()
+JSSkeletonRegex = re.compile(r'<div id="(?:root|app)">\s*</div>|<app-root', re.IGNORECASE)
+
+# A page got by plain HTTP request that has fewer links than this is considered JS-generated and is rendered in the headless Firefox. (Any real page of a portal has at least a navigation.)
+minStaticPageLinks = 20
+# Maximum time (in seconds) to wait for the headless Firefox to render the content of a JS-generated page (see renderPage())
+browserWaitTimeout = 10
+# JS condition telling that a page in the browser is rendered: the document is completely loaded and the application root element (the same ones JSSkeletonRegex looks for), if there's any, has got its content.
+# A page without an application root (e.g., a small static page or an error page) meets it as soon as it's loaded, so it isn't waited for any longer.
+renderedPageCondition = "var root = document.querySelector('#root, #app, app-root'); return document.readyState === 'complete' && (root === null || root.childElementCount > 0);"
+
+# Number of threads checking the normal links in parallel (see checkLink()). Keep it lower than the pool_maxsize of the session adapter.
+linkCheckWorkers = 32
+# At most this many of the link-check threads send requests to the same host at once, so a host with many links doesn't get hammered by all of them (see getHostSemaphore()).
+linkChecksPerHost = 8
+hostSemaphores = {}
+hostSemaphoresLock = threading.Lock()
+
+# Cache of the normal links found OK in the previous runs (see openLinkCache()), an SQLite DB in the current directory. Used only with the --cache switch. Links checked within the last linkCacheTTL seconds aren't checked again.
+linkCacheFile = ".njord_cache.sqlite"
+linkCacheTTL = 24 * 60 * 60
+
 # Prepare a session for requests module and initialize headless Firefox.
 # Headless Firefox is used to check validity of anchors. Requests are used to check validity of normal links.
 # Why not use one for both tasks? 
@@ -83,22 +172,50 @@ URLPath = domain + folder
 # Requests
 #     According to the docs, using sessions can significantly improve performance -- "if you’re making several requests to the same host, the underlying TCP connection will be reused"
 #     https://requests.readthedocs.io/en/latest/user/advanced/#session-objects
-#     Potentially useful for setting up retry policy: https://stackoverflow.com/a/47475019/2216968 (from requests.adapters import HTTPAdapter and from urllib3.util.retry import Retry)
+#     Retry policy and connection pool set up as per https://stackoverflow.com/a/47475019/2216968
+#     The adapter is mounted before anything (the sitemap included) is fetched, so every request goes thru the same pool of kept-alive connections.
 sessionForRequests = requests.Session()
+#     raise_on_status=False: when the retries run out on a 5xx (or 429), return the last response instead of raising RetryError, so the link is reported with its HTTP code (as an error), not as an unresolved link.
+retryPolicy = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+#     pool_connections is the number of hosts whose connections are kept (the link checks go to many different hosts), pool_maxsize the number of connections kept per host (all the link-check and crawl threads may hit the same host at once).
+sessionAdapter = HTTPAdapter(pool_connections=64, pool_maxsize=64, max_retries=retryPolicy)
+sessionForRequests.mount("http://", sessionAdapter)
+sessionForRequests.mount("https://", sessionAdapter)
 
 #     Add an accepted user agent to the Sessions so certain pages (like prerender.io) don't block the requests with 403 or close the connection without a response altogether:
-#     sessionForRequests.headers.update({'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:12.0) Gecko/20100101 Firefox/12.0'})
-sessionForRequests.headers.update({'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/51.0.2704.103 Safari/537.36'})
+#     Also ask explicitly for HTML so the servers that negotiate content don't send something bigger/different.
+#     Accept-Encoding and keep-alive are left at the requests' defaults -- "gzip, deflate" (plus "br" when the brotli module is installed, otherwise requests couldn't decode it) and "Connection: keep-alive".
+sessionForRequests.headers.update({
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/51.0.2704.103 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml;q=0.9,*/*;q=0.8'
+})
 
 # Headless Firefox
-#     Initialize headless Firefox browser.
+#     Options of the headless Firefox browsers.
 #     The initialization and generally page processing can take VERY long time (couple of seconds for the init and then per request).
+#     That's why the browsers are started only when a page needs to be rendered, see getBrowser().
 opts = FirefoxOptions()
 opts.add_argument("--headless")
-browser = webdriver.Firefox(options=opts)
+#     Only the DOM (IDs and links) is read from the pages, so don't download images, stylesheets, web fonts and media, nor show notifications.
+opts.set_preference('permissions.default.image', 2)
+opts.set_preference('permissions.default.stylesheet', 2)
+opts.set_preference('gfx.downloadable_fonts.enabled', False)
+opts.set_preference('media.autoplay.default', 5)
+opts.set_preference('dom.webnotifications.enabled', False)
+#     Return from get() as soon as the DOM is ready, without waiting for the rest of the subresources. The JS-generated content is waited for explicitly (see fetchPage()).
+opts.page_load_strategy = 'eager'
 # Optional for possible future reference. The executable_path isn't mandatory if geckodriver is in ${PATH}.
 # browser = webdriver.Firefox(options=opts, executable_path='/usr/bin/geckodriver')
 
+#     The pages from the sitemap are got in parallel by a pool of threads (see fetchPage()). The webdriver isn't thread safe, so each of the threads has its own headless Firefox stored in browserThreadData.
+#     All the browsers are listed in browsers so that finishAndQuit() can close them.
+browserThreadData = threading.local()
+browsers = []
+#     Once closeBrowsers() has run, no new browser may be started: a worker still busy with a plain request could otherwise start one after that and nobody would ever quit it.
+browsersClosing = False
+#     (An RLock, because the Ctrl-C handler closes the browsers and may run in the main thread while it's holding the lock.)
+browsersLock = threading.RLock()
+
 # Define colors. 
 # If the OS we're on is Windows, drop that and just fill the variables with empty strings. Handling colors in Windows command prompt isn't worth the effort.
 if sys.platform != 'win32':
@@ -126,6 +243,10 @@ else:
         UNDERLINE = ''
         END = ''
 
+# Beginnings of the error and warning messages, put together once here instead of in every printNOK() call
+errorStart = color.RED + color.BOLD
+warningStart = color.YELLOW + color.BOLD
+
 # Function that prints all the errors and warnings. It consumes:
 #     the page (title & URL) an issue is on (var page), 
 #     boolean telling whether it's the first error for the page (var first), 
@@ -151,38 +272,42 @@ def printNOK(pg="", ln="", first=False, type=None, redir="", errorCode=""):
                   or type == 'sitemapNotFound' \
                   or type == 'absorel' \
                 ):
-        if pagesLinksAndAnchors:
-            print("Issues in " + color.BOLD + pagesLinksAndAnchors[page]['title'] + color.END + " (" + pg + ")")
+        # Look the page up by 'pg', not the global loop variable -- the pages are processed in parallel, and errors from the crawl have no page record at all.
+        pageRecord = pagesLinksAndAnchors.get(pg)
+        if pageRecord is not None:
+            print("Issues in " + color.BOLD + pageRecord.title + color.END + " (" + pg + ")")
+        elif pg:
+            print("Issues in " + pg)
         else:
             print("Some intial generic error occurred")
 
     # Outside page threw 404
     if type == '404':
-        print(color.RED + color.BOLD + "Outsite anchor link unreachable: " + color.END + ln)
+        print(errorStart + "Outsite anchor link unreachable: " + color.END + ln)
         internalExitCode = 1
         first = False
 
     # Remote sitemap not found
     elif type == 'sitemapNotFound':
-        print(color.RED + color.BOLD + "Remote sitemap not found under this URL (manually set or autogenerated as `domain + folder + sitemap.xml`): " + color.END + ln)
+        print(errorStart + "Remote sitemap not found under this URL (manually set or autogenerated as `domain + folder + sitemap.xml`): " + color.END + ln)
         internalExitCode = 1
         first = False
 
     # Internal page threw 404
     elif type == 'internalSitemap404':
-        print(color.RED + color.BOLD + "URL in the sitemap unreachable: " + color.END + ln)
+        print(errorStart + "URL in the sitemap unreachable: " + color.END + ln)
         internalExitCode = 1
         first = False
 
     # Can't perfom initial processing of a page
     elif type == 'cantProcessPage':
-        print(color.RED + color.BOLD + "Can't process (find title and links) this page: " + color.END + ln)
+        print(errorStart + "Can't process (find title and links) this page: " + color.END + ln)
         internalExitCode = 1
         first = False
 
     # The sitemap doesn't contain any URL that matches the 'domain'+'folder' combination.
     elif type == 'noSitemapMatch':
-        print(color.RED + color.BOLD + "No page URL in the sitemap matches the URL path you've entered: " + color.END + URLPath)
+        print(errorStart + "No page URL in the sitemap matches the URL path you've entered: " + color.END + URLPath)
         internalExitCode = 1
         first = False
 
@@ -191,7 +316,7 @@ def printNOK(pg="", ln="", first=False, type=None, redir="", errorCode=""):
         pass
         # if beQuiet == False:
         #     # NOTE: DISABLING THIS AS NOT NEEDED NOW
-        #     print(color.YELLOW + color.BOLD + "WARNING: relative link with absolute URL: " + color.END + ln)
+        #     print(warningStart + "WARNING: relative link with absolute URL: " + color.END + ln)
         #     first = False
 
     # Anchor link looks like internal but we didn't download it (wasn't in the sitemap?). This error can easily be circumvented by doing additional GET, but it's a nice check for a random sitemap error.
@@ -199,48 +324,59 @@ def printNOK(pg="", ln="", first=False, type=None, redir="", errorCode=""):
         if beQuiet == False:
             # Add the final link destination URL only if it's different from the original URL found in the current page. 
             # Printing only the redirect wouldn't be helpful because you wouldn't then find it in the page.
-            if link != redir:
+            if ln != redir:
                 redirNote = " (Redirects to: " + redir + " )"
             else:
                 redirNote = ""
-            print(color.YELLOW + color.BOLD + "Can't check anchor validity:" + color.END + " the target page not in current DB (probably wasn't in the sitemap). Link: " + link + redirNote)
+            print(warningStart + "Can't check anchor validity:" + color.END + " the target page not in current DB (probably wasn't in the sitemap). Link: " + ln + redirNote)
             first = False
 
     # Outside link isn't in DB and 'no-external' is True, so we can't fetch the page to check it (obviously...)
     elif type == 'cantGoOutside':
         if beQuiet == False:
-            print(color.YELLOW + color.BOLD + "Can't check anchor validity:" + color.END + " the target page not in current DB and you forbade me to probe pages outside domain + folder (-x switch). Link: " + ln)
+            print(warningStart + "Can't check anchor validity:" + color.END + " the target page not in current DB and you forbade me to probe pages outside domain + folder (-x switch). Link: " + ln)
             first = False
 
     # External broken anchor, we're treating it as a warning only
     elif type == "externalNOK":
         if beQuiet == False:
-            print(color.YELLOW + color.BOLD + "External anchor doesn't seem to exist: " + color.END + ln)
+            print(warningStart + "External anchor doesn't seem to exist: " + color.END + ln)
             first = False
 
     # External normal link either didn't resolve or timed out. We know the HTTP error code, so we treat it as an error.
     elif type == "normalLinkUnreachable":
-        print(color.RED + color.BOLD + "Link unreachable (HTTP code " + str(errorCode) + "): " + color.END + ln)
+        print(errorStart + "Link unreachable (HTTP code " + str(errorCode) + "): " + color.END + ln)
         internalExitCode = 1
         first = False
 
     # We failed to get a normal link and don't know the HTTP error code, hence treating this as a warning (it could be a working site that just hates us)
     elif type == "normalLinkUnresolved":
-        print(color.YELLOW + color.BOLD + "URL resolution or time-out error. Manual check advised (HTTP code " + str(errorCode) + "): " + color.END + ln)
+        print(warningStart + "URL resolution or time-out error. Manual check advised (HTTP code " + str(errorCode) + "): " + color.END + ln)
         first = False
 
     # Anchor (ID) isn't in the target page (error type for this function is unspecified)
     else:
-        print(color.RED + color.BOLD + "Anchor NOK: " + color.END + ln)
+        print(errorStart + "Anchor NOK: " + color.END + ln)
         internalExitCode = 1
         first = False
 
     exitCode = internalExitCode
     return first
 
+# Record of a page in the main DB (pagesLinksAndAnchors).
+# A slotted dataclass instead of a dict per page: it takes about a third of the memory and an attribute access is faster than a dict key lookup.
+@dataclass(slots=True)
+class PageRecord:
+    title: str
+    anchorLinks: tuple
+    normalLinks: tuple
+    anchors: frozenset
+
 # Set up the variables
 absorel = 0
-checkedLinks = {}
+checkedLinksCode = {}
+checkedLinksStatus = {}
+deadHosts = set()
 linksInSitemap = 0
 missed = 0
 nokAnchorOutside = 0
@@ -251,29 +387,51 @@ okAnchorOutside = 0
 okInPage = 0
 okInternal = 0
 okNormalLinks = 0
+outsidePagesAnchors = {}
 pagesChecked = 0
 pagesLinksAndAnchors = {}
+redirectCache = {}
 retrieved = 0
-sitemapFail = False
 unreachable = 0
-wasAbsorel = {}
+wasAbsorel = defaultdict(set)
 # Notes about pagesLinksAndAnchors:
-#     Prepare dictionary with the following structure (each URL is a page from the sitemap). This is the main DB we're working with:
+#     Prepare dictionary with the following structure (each URL is a page from the sitemap, each value is a PageRecord). This is the main DB we're working with:
 #         pagesLinksAndAnchors
 #         {
-#             "URL": {
-#                 "title": "Lipsum",
-#                 "anchor-links": [ "https://example.org/page-1#anchor01", "intrapage-anchor" ],
-#                 "normal-links": [ "https://example.org/page-3", "https://3x4mple.org/page-4" ],
-#                 "anchors": ["anchor-1", "anchor-2"]
-#             }
+#             "URL": PageRecord(
+#                 title = "Lipsum",
+#                 anchorLinks = ( "https://example.org/page-1#anchor01", "intrapage-anchor" ),
+#                 normalLinks = ( "https://example.org/page-3", "https://3x4mple.org/page-4" ),
+#                 anchors = frozenset({"anchor-1", "anchor-2"})
+#             )
 #         }
 
+# Note about checkedLinksStatus and checkedLinksCode
+#     The checked normal links DB is split into two flat dictionaries keyed by the link instead of one dictionary holding a small {'status': ..., 'code': ...} dictionary per link.
+#     checkedLinksStatus holds "OK" or "NOK", checkedLinksCode the HTTP status code (or "unknown" if the request didn't get any response). A link is in both or in neither.
+
+# Note about deadHosts
+#     Set of the hosts that couldn't be connected to (see isConnectionRefused()), by normal links (checkLink()) or outside pages of anchor links (getOutsidePageAnchors()). It's written by the worker threads, set.add() is atomic, so no lock is needed.
+
 # Note about wasAbsorel
 #     Set up a dictionary for absolute links within the portal. We want to report these as suboptimal.
+#     Key is the page URL, value is a set of the absolute links in the page (they're only ever tested for membership). defaultdict creates the set on the first link of the page.
+#     (Look it up with wasAbsorel.get(page, ()), indexing a page without such links would add an empty set for it.)
+
+# Note about redirectCache
+#     Final (redirected) URLs of the internal anchor links' base URLs that aren't in the main DB. None if the URL couldn't be resolved.
+
+# Note about outsidePagesAnchors
+#     Cache of pages that aren't in the main DB (outside pages and internal pages not in the sitemap), see getOutsidePageAnchors().
+#     Key is the page URL without the anchor, value is a frozenset of the anchors in the page (or None if the page couldn't be fetched).
 
 # Function to print stats when the script finishes
 def printStats():
+    # With the links cache on, tell how many of the OK links weren't really checked in this run
+    if useCache:
+        cacheNote = ", " + str(sum(1 for link in checkedLinksStatus if link in cachedOKLinks)) + " unique from the links cache"
+    else:
+        cacheNote = ""
     print(color.BOLD + "\n===== STATS ===== " + color.END + \
           " \nTotal URLs in sitemap: " + str(linksInSitemap) + \
           " \nTotal pages the DB: " + str(len(pagesLinksAndAnchors)) + \
@@ -285,7 +443,7 @@ def printStats():
           "\n\tNOK - internal: " + str(nokInternal) + \
           "\n\tOK outside portal: " + str(okAnchorOutside) + \
           "\n\tNOK outside portal: " + str(nokAnchorOutside) + \
-          "\nOK - normal links: " + str(okNormalLinks) + " (" + str(len(checkedLinks)) + " unique)" \
+          "\nOK - normal links: " + str(okNormalLinks) + " (" + str(len(checkedLinksStatus)) + " unique" + cacheNote + ")" \
           "\nUnreachable links: " + str(unreachable) + \
           "\nAbsolute URLs within Domain: " + str(absorel) + \
           "\nPages not in sitemap: " + str(notInSitemap) + \
@@ -296,110 +454,350 @@ def printDebugTime(message, blockStartTime, scriptStartTime):
     print(message + " " + str(round(time.time() - blockStartTime)) + " sec. (" + str(round(time.time() - scriptStartTime)) + " since start)")
     return time.time()
 
-def finishAndQuit(errCode=0, browser=None):
-    # Finished, close temporary headless Firefox and print statistics.
+# Function that returns the headless Firefox of the current thread. The browser is started on the first call in the thread.
+# Raises WebDriverException once the browsers are being closed (see closeBrowsers()).
+def getBrowser():
+    if browsersClosing:
+        raise WebDriverException("The browsers are being closed")
+    if not hasattr(browserThreadData, 'browser'):
+        # Starting the browser takes long, so it's done outside the lock. Whether the browsers got closed meanwhile is checked again under the lock.
+        browser = webdriver.Firefox(options=opts)
+        with browsersLock:
+            if browsersClosing:
+                try:
+                    browser.quit()
+                except WebDriverException:
+                    pass
+                raise WebDriverException("The browsers are being closed")
+            browsers.append(browser)
+        browserThreadData.browser = browser
+    return browserThreadData.browser
+
+# Function that gets a page by a plain HTTP request and returns the response.
+# requests assumes ISO-8859-1 for HTML served without charset, the pages are mostly UTF-8 though.
+def requestPage(pageURL, timeout=20):
+    pageReq = sessionForRequests.get(pageURL, timeout=timeout)
+    if 'charset' not in pageReq.headers.get('Content-Type', ''):
+        pageReq.encoding = 'utf-8'
+    return pageReq
+
+# Function that returns anchors (IDs and names) of a page that isn't in the main DB.
+# Many anchor links lead to the same page (only with different anchors) and footers or navigations repeat on every page, so each page is downloaded only once per run and its anchors are cached in outsidePagesAnchors.
+# The anchors usually only need the raw HTML, so the page is got by a plain HTTP request, not in the (by orders of magnitude slower) headless Firefox.
+# Only if the raw HTML has no anchors at all or looks JS-generated (see JSSkeletonRegex), the page is rendered in the browser and the anchors are taken from the rendered page.
+# The same goes for pages answering with an error code other than 404/410 -- some hosts (Cloudflare, Zapier, Adobe, ... see isSkippedLink()) refuse the requests client with 403 or so, but serve the headless Firefox.
+# The outside pages are got in parallel by the crawl threads before the checking loop (each URL by one thread only), so the loop mostly reads the cache.
+# Returns None if the page couldn't be fetched (including HTTP codes >399).
+def getOutsidePageAnchors(pageURL):
+    if pageURL not in outsidePagesAnchors:
+        # Don't try malformed URLs (see splitLink()) nor hosts that couldn't be connected to (see deadHosts), a dead host is often linked from many pages
+        outsideParts = splitLink(pageURL)
+        if outsideParts is None or outsideParts.hostname in deadHosts:
+            outsidePagesAnchors[pageURL] = None
+            return None
+        outsideHost = outsideParts.hostname
+        try:
+            outsideReq = requestPage(pageURL, timeout=15)
+            # The page really isn't there
+            if outsideReq.status_code in (404, 410):
+                outsidePagesAnchors[pageURL] = None
+            else:
+                outsideAnchors = findAttrValues(anchorAttrRegex, outsideReq.text) if outsideReq.status_code < 400 else []
+                if outsideReq.status_code >= 400 or not outsideAnchors or JSSkeletonRegex.search(outsideReq.text):
+                    try:
+                        outsideAnchors = findAttrValues(anchorAttrRegex, renderPage(pageURL))
+                    except WebDriverException:
+                        # The browser failed too. A page that answered with an error code is unreachable, otherwise take the anchors from the raw HTML.
+                        if outsideReq.status_code >= 400:
+                            outsideAnchors = None
+                outsidePagesAnchors[pageURL] = None if outsideAnchors is None else frozenset(outsideAnchors)
+        except requests.ConnectionError as err:
+            if isConnectionRefused(err):
+                deadHosts.add(outsideHost)
+            outsidePagesAnchors[pageURL] = None
+        except requests.RequestException:
+            outsidePagesAnchors[pageURL] = None
+    return outsidePagesAnchors[pageURL]
+
+# Function that returns the final URL the link base URL redirects to (or the URL itself if it doesn't redirect). Returns None if the URL can't be resolved.
+def resolveRedirect(linkBaseURL):
+    # The redirects are resolved in parallel and they're all on the portal host, so hold the host's semaphore like the link checks do (see getHostSemaphore())
+    linkParts = splitLink(linkBaseURL)
+    if linkParts is None:
+        return None
+    try:
+        with getHostSemaphore(linkParts.hostname):
+            return sessionForRequests.head(linkBaseURL, timeout=10, allow_redirects=True).url
+    except requests.RequestException:
+        return None
+
+# Function that returns the URL in its canonical form: the scheme and host lowercased and the fragment (#...) dropped, so that variants of one page URL compare equal.
+def canonicalURL(URL):
+    URLParts = urlsplit(URL)
+    return urlunsplit((URLParts.scheme.lower(), URLParts.netloc.lower(), URLParts.path, URLParts.query, ""))
+
+# Function that downloads the sitemap and returns URLs of the pages in it that match the URL path (domain + folder).
+# The sitemap is parsed as a stream while it's being downloaded (it can have tens of MB), each element is released as soon as it's been read.
+# Returns None if the sitemap can't be downloaded or parsed.
+def getSitemapURLs(sitemapURL):
+    try:
+        with sessionForRequests.get(sitemapURL, timeout=20, stream=True) as sitemapReq:
+            if sitemapReq.status_code >= 400:
+                return None
+            # Let urllib3 decompress gzipped responses, the parser reads the raw stream
+            sitemapReq.raw.decode_content = True
+            # dict keeps the order and drops the URLs listed more than once (see canonicalURL()), so no page is fetched twice
+            sitemapURLs = {}
+            for event, element in ET.iterparse(sitemapReq.raw, events=('end',)):
+                # The <loc> tag is namespaced (http://www.sitemaps.org/schemas/sitemap/0.9) in most of the sitemaps
+                if element.tag == 'loc' or element.tag.endswith('}loc'):
+                    loc = (element.text or "").strip()
+                    if loc.startswith(URLPath):
+                        sitemapURLs.setdefault(canonicalURL(loc))
+                element.clear()
+            return list(sitemapURLs)
+    except (requests.RequestException, ET.ParseError):
+        return None
+
+# Function run by the worker threads of the sitemap crawl. Gets the page and returns its source.
+#     First, the page is got by a plain HTTP request, which is by orders of magnitude faster than rendering it in the browser.
+#     Only if that fails or the page looks JS-generated (an empty application skeleton or too few links), the page is got in the worker's own headless Firefox (see getBrowser()).
+#     With the --browser-only switch, all pages are got in the browser. With --js-pages, the matching pages are.
+# Returns None if the page couldn't be fetched.
+def fetchPage(pageURL):
+    if not browserOnly and not (JSPagesRegex and JSPagesRegex.search(pageURL)):
+        try:
+            pageReq = requestPage(pageURL)
+            if pageReq.status_code < 400 \
+                and not JSSkeletonRegex.search(pageReq.text) \
+                and len(normalLinkRegex.findall(pageReq.text)) >= minStaticPageLinks:
+                return pageReq.text
+        except requests.RequestException:
+            pass
+
+    try:
+        return renderPage(pageURL)
+    except WebDriverException:
+        return None
+
+# Function that gets the page in the current thread's headless Firefox (see getBrowser()) and returns the rendered source.
+# get() returns once the DOM is ready, but the JS may still be building the content. Wait until the page is rendered (see renderedPageCondition), at most browserWaitTimeout seconds, instead of a fixed sleep.
+# If it doesn't get there in time, take what's rendered. Raises WebDriverException if the browser fails.
+def renderPage(pageURL):
+    browser = getBrowser()
+    browser.get(pageURL)
+    try:
+        WebDriverWait(browser, browserWaitTimeout).until(lambda renderedPage: renderedPage.execute_script(renderedPageCondition))
+    except TimeoutException:
+        pass
+    return browser.page_source
+
+# Function splitting a link into its parts (scheme, host, path, ...). urlsplit() is pure Python and the same link is split by isSkippedLink() and again by checkLink(), so the results are kept (lru_cache is thread-safe).
+# Returns None if the link is malformed (urlsplit() raises ValueError, e.g., on an unclosed IPv6 bracket like 'http://[bad/x').
+@lru_cache(maxsize=16384)
+def splitLink(link):
+    try:
+        return urlsplit(link)
+    except ValueError:
+        return None
+
+# Function that decides whether a normal link is left out of the testing.
+# The navigation, header and footer links repeat in every page, so the answers are kept and each unique link is tested only once.
+@lru_cache(maxsize=16384)
+def isSkippedLink(link):
+    # Links left out:
+    #    Fonts (local and those on cdnfonts, because CDNFonts returns 403 even if the URL is valid)
+    #    Random example / showcase domains or parts of URLs
+    #   Azure throws requests into exception block
+    #    Codepen.io blocks Requests entirely with 403
+    #     Zapier.com is OK with headless Firefox but refuses requests library, Twitter throws 400 to requests, Adobe 403
+    #    Cloudflare refuses everything, possible solution is another webdriver: https://stackoverflow.com/questions/68289474/selenium-headless-how-to-bypass-cloudflare-detection-using-selenium
+    #    https://business.adobe.com times out on bots (it looks for more than just a user agent, similar to Zapier or Cloudflare).
+    #    '%7B' is URL-encoded curly bracket '{' -- can be used in example URLs to encapsulate variables ('{var}')
+    # The host rules are looked up by the host of the link (see skippedLinkHosts), so only the path beginnings of that one host are compared. The rest are plain string tests, no regex is needed.
+    if link.startswith('mailto:') or link.endswith(skippedLinkEndings) or any(part in link for part in skippedLinkParts):
+        return True
+    linkParts = splitLink(link)
+    # A malformed link isn't skipped, it's checked (and reported as unresolved, see checkLink()).
+    if linkParts is None:
+        return False
+    return linkParts.path.startswith(skippedLinkHosts.get(linkParts.hostname, ()))
+
+# Function that returns the semaphore limiting the concurrent link checks on the host. It's created on the first call for the host.
+def getHostSemaphore(host):
+    with hostSemaphoresLock:
+        if host not in hostSemaphores:
+            hostSemaphores[host] = threading.BoundedSemaphore(linkChecksPerHost)
+        return hostSemaphores[host]
+
+# Function that tells whether the request failed because the connection couldn't be even opened (the host name doesn't resolve or the host refuses connections, even after the retries). Such hosts are remembered as dead in deadHosts.
+def isConnectionRefused(err):
+    return bool(err.args) and isinstance(err.args[0], MaxRetryError) and isinstance(err.args[0].reason, NewConnectionError)
+
+# Function run by the link-check worker threads. Gets the HTTP status code of a normal link and returns it as a (status, code) pair for the checked links DB.
+def checkLink(link):
+    # Links found OK in a recent run aren't checked again (see openLinkCache()).
+    if link in cachedOKLinks:
+        return "OK", cachedOKLinks[link]
+    # Hosts that couldn't be connected to at all (see below) aren't tried again, that would only wait for the retries and timeouts once more.
+    linkParts = splitLink(link)
+    # A malformed link can't be requested at all, we don't know the code
+    if linkParts is None:
+        return "NOK", "unknown"
+    linkHost = linkParts.hostname
+    if linkHost in deadHosts:
+        return "NOK", "unknown"
+    # Try to get the link and its response code
+    # The except block is for the portals that block direct HTTP requests
+    try:
+        with getHostSemaphore(linkHost):
+            # Only the status code is needed, so HEAD is enough (no body is downloaded). Servers that don't allow HEAD answer 405 (or 403 if they just refuse it, or 501 if they don't implement it), those get GET.
+            req = sessionForRequests.head(link, timeout=10, allow_redirects=True)
+            if req.status_code in (403, 405, 501):
+                # The body isn't needed even then, so it's streamed and the response is closed right after the headers arrive (the body is never downloaded).
+                req = sessionForRequests.get(link, timeout=10, stream=True)
+                req.close()
+        if req.status_code < 400:
+            return "OK", req.status_code
+        return "NOK", req.status_code
+    except requests.ConnectionError as err:
+        if isConnectionRefused(err):
+            deadHosts.add(linkHost)
+        return "NOK", "unknown"
+    except requests.RequestException:
+        # We don't know the code because the request got blocked altogether
+        return "NOK", "unknown"
+
+# Function opening the cache of the normal links found OK in the previous runs. Returns the cache DB connection (None if the cache is off or unusable) and a dict of the cached links and their HTTP codes.
+#     Only OK links are cached. A NOK link is always checked again, so a fixed link doesn't keep being reported. An OK link that broke since is found once its cache entry expires.
+#     The dict is only read by the link-check threads. The DB is used from the main thread only (an SQLite connection can't be shared between threads).
+def openLinkCache():
+    if not useCache:
+        return None, {}
+    try:
+        cacheDB = sqlite3.connect(linkCacheFile)
+        cacheDB.execute('CREATE TABLE IF NOT EXISTS okLinks (link TEXT PRIMARY KEY, code INTEGER, checked INTEGER)')
+        return cacheDB, dict(cacheDB.execute('SELECT link, code FROM okLinks WHERE checked > ?', (int(time.time()) - linkCacheTTL,)))
+    except sqlite3.Error:
+        if beQuiet == False:
+            print(warningStart + "WARNING: Can't use the links cache, all the links will be checked: " + color.END + linkCacheFile)
+        return None, {}
+
+# Function storing the newly checked OK links to the links cache. (The links taken from the cache keep their original time, so they expire.)
+def saveLinkCache(results):
+    if linkCacheDB is None:
+        return
+    checked = int(time.time())
+    try:
+        with linkCacheDB:
+            linkCacheDB.executemany('INSERT OR REPLACE INTO okLinks VALUES (?, ?, ?)', \
+                ((link, code, checked) for link, (status, code) in results.items() if status == "OK" and link not in cachedOKLinks))
+    except sqlite3.Error:
+        if beQuiet == False:
+            print(warningStart + "WARNING: Can't store the checked links to the links cache: " + color.END + linkCacheFile)
+
+# Function that closes all the started headless Firefox browsers. Each browser is removed from the list as it's closed, so calling this again (see the end of the main block) doesn't touch the closed ones.
+def closeBrowsers():
+    global browsersClosing
+    with browsersLock:
+        browsersClosing = True
+        while browsers:
+            try:
+                browsers.pop().quit()
+            except WebDriverException:
+                # The browser (or its geckodriver) is already gone
+                pass
+
+def finishAndQuit(errCode=0):
+    # Finished, close temporary headless Firefox browsers (if any were started) and print statistics.
     print("Finished...")
-    if browser:
-        print("... exiting the browser...")
-        browser.quit()
-        printStats()
+    if browsers:
+        print("... exiting the browsers...")
+        closeBrowsers()
+    printStats()
 
     print("... and closing.")
 
     sys.exit(errCode)
 
+# Function handling Ctrl-C (SIGINT). Without it, the interruption would leave the geckodriver and Firefox processes of the started browsers behind.
+# Close the browsers, print the stats gathered so far and exit with 130 (the conventional exit code for SIGINT).
+def interruptHandler(signalNumber, frame):
+    print("\nInterruption code (^C) caught, terminating now.")
+    finishAndQuit(130)
+
+# The cache is opened before the Ctrl-C handler is set, printStats() reads it.
+linkCacheDB, cachedOKLinks = openLinkCache()
+
+signal.signal(signal.SIGINT, interruptHandler)
+
 if beVerbose:
     debugTime = printDebugTime("Initialization took", startTime, startTime)
 
+# The last processed page and link, reported if anything fails in the main block below. (Initialized, so the report itself can't fail on an undefined name when the failure comes early.)
+URL = page = link = ""
+# The thread pools of the main block, shut down at its end whatever way it ends
+crawlExecutor = linkCheckExecutor = None
+
 try:
     # Get the sitemap
-    # Open locally saved sitemap
-    # sitemap=str(open("sitemap.xml", "r").read())
-    # Get the whole live sitemap, read the HTTP object and convert it to string. Requires import requests.
     if manualSitemapLoc:
-        print("Getting the remote sitemap from manually selected location: " + manualSitemapLoc)
-        try:
-            sitemapReq = sessionForRequests.get(manualSitemapLoc, timeout=20)
-            if sitemapReq.status_code < 400:
-                sitemap = sitemapReq.text
-            else:
-                firstError = printNOK("", manualSitemapLoc, True, "sitemapNotFound")
-                sitemapFail = True
-        except:
-            firstError = printNOK("", manualSitemapLoc, True, "sitemapNotFound")
-            sitemapFail = True
+        sitemapURL = manualSitemapLoc
+        print("Getting the remote sitemap from manually selected location: " + sitemapURL)
 
     else:
         # Automatically guess sitemap location. It should domain+folder+'/sitemap.xml' according to https://www.sitemaps.org/protocol.html#location)".
         sitemapURL = domain + folder + "/sitemap.xml"
         print("Getting the remote sitemap. Assuming it's at " + sitemapURL + "\n") 
-        try:
-            sitemapReq = sessionForRequests.get(sitemapURL, timeout=20)
-            if sitemapReq.status_code < 400:
-                sitemap = sitemapReq.text
-            else:
-                firstError = printNOK("", sitemapURL, True, "sitemapNotFound")
-                sitemapFail = True
-        except:
-            firstError = printNOK("", sitemapURL, True, "sitemapNotFound")
-            sitemapFail = True
 
-    if sitemapFail:
-        finishAndQuit(exitCode, browser)
+    # Find all URLs with the URLPath in the sitemap file. See getSitemapURLs() for details.
+    URLs = getSitemapURLs(sitemapURL)
 
-    if beVerbose:
-        debugTime = printDebugTime("Getting the sitemap took", debugTime, startTime)
+    if URLs is None:
+        firstError = printNOK("", sitemapURL, True, "sitemapNotFound")
+        finishAndQuit(exitCode)
 
-    # Find all URLs with the URLPath in the sitemap file. "rf" in findall meaninings: r=regex, f=allow variables in the string searched for. 
-    # Regexes (and all the match, search, and findall) require import re.
-    URLs = re.findall(rf'({URLPath}.*?)</loc>', sitemap)
     linksInSitemap = len(URLs)
 
     if beVerbose:
-        debugTime = printDebugTime("Parsing the URLs in the sitemap took", debugTime, startTime)
+        debugTime = printDebugTime("Getting and parsing the sitemap took", debugTime, startTime)
 
     # Go thru the URLs obtained from the sitemap and get anchor links and IDs from them so we can check them later.
-    for URL in URLs:
+    # The pages are downloaded in parallel by the crawl workers (see fetchPage()), the results are processed here in the main thread in the sitemap order.
+    # The normal links are checked by another pool of threads (see checkLink()) while the pages are still being downloaded and parsed. linkCheckFutures maps each unique link to its pending check.
+    crawlExecutor = ThreadPoolExecutor(max_workers=crawlWorkers)
+    linkCheckExecutor = ThreadPoolExecutor(max_workers=linkCheckWorkers)
+    linkCheckFutures = {}
+    for URL, document in zip(URLs, crawlExecutor.map(fetchPage, URLs)):
         retrieved += 1
 
-        # Get the document source
-        # Just a reminder: browser is an instance of headless Firefox. sessionForRequests is an instance of requests.
-        try:
-            browser.get(URL)
-            # time.sleep(1)
-
-            document = browser.page_source
-        
-        except:
+        if document is None:
             firstError = printNOK("", URL, firstError, "internalSitemap404")
+            continue
 
         # Try to get all the pages data and links. If anything in here fails, drop the whole page.
         try:
             # Get the document's <title>
             # re.DOTALL makes sure the title is matched even if the tag spans multiple lines
-            title = re.search(rf'<title.*?>(.*?)</title>',document,re.DOTALL).group(1)
-
-            # Prepare sub-dictionary for the document. See details about the structure above the initiation of the dictionary
-            pagesLinksAndAnchors[URL] = {}
-            pagesLinksAndAnchors[URL]['title'] = title
+            title = titleRegex.search(document).group(1)
 
             # Get links with anchors (hash followed by at least one character except for a closing quote) in the document
-            anchorLinks = re.findall(rf'href="([^"]*?#[^\"]+?)"', document)
+            anchorLinks = findAttrValues(anchorLinkRegex, document)
 
             # Get non-anchor links (opening quotes followed by at least one character and the link doesn't contain a hash) in the document
-            normalLinks = re.findall(rf'<a [^>]*?href="([^"#]+?)"', document)
+            normalLinks = findAttrValues(normalLinkRegex, document)
 
-            # Prepend relative anchor links that lead to 1-N levels up with the current URL so that they don't appear to be in-page anchor links.
-            j = 0
-            while j < len(normalLinks):
-                if re.match("../", normalLinks[j]):
-                    if not URL.endswith('/'):
-                        URL = URL + '/'
-                    normalLinks[j] = re.sub(rf'^../', URL + '../', normalLinks[j])
-                j += 1
+            # Relative links that lead to 1-N levels up are resolved against the current URL (so that relative anchor links don't appear to be in-page anchor links).
+            # The pages are treated as directories (the URL always ends with a slash for the resolution). Note: URL itself mustn't be changed, it's the key in the main DB.
+            baseURL = URL if URL.endswith('/') else URL + '/'
+            normalLinks = [urljoin(baseURL, normalLink) if normalLink.startswith('../') else normalLink for normalLink in normalLinks]
 
-            # Assign the normal links to the main DB of documents w/ links inside them now, as they don't need further cleaning (unlike anchors)
-            pagesLinksAndAnchors[URL]['normal-links'] = normalLinks
+            # Normalize and filter the normal links right away, so each link is handled once and not again when it's checked and reported:
+            #     If the link is relative, add the domain to it to make it absolute including the protocol.
+            #     The links we don't check (see isSkippedLink()) are dropped.
+            # Links repeated within the page (e.g., in the navigation and the footer) are stored only once. dict.fromkeys() removes the duplicates and keeps the order.
+            normalLinks = [domain + normalLink if normalLink.startswith('/') else normalLink for normalLink in normalLinks]
+            normalLinks = tuple(dict.fromkeys(normalLink for normalLink in normalLinks if not isSkippedLink(normalLink)))
 
             # Cleaning up some anchor mess. Delete:
             #   The satisfactory level links found in /iam/iga/capabilities/summary/ are not anchor links
@@ -407,45 +805,41 @@ try:
             #   Postman app links -- the hash character doesn't mean it's an anchor
             #   Postman learn -- seems the document is JS generated so we can't effectively check anything. Also, Postman likes to ban us.
             #   Links longer than 2048 character. These are quite probably some weirdness like links to diagram.net that have the whole diagram encoded into the URL, apparently. The hash character there doesn't stand for an anchor anyway..
-            # Note: We can safely do this in one loop because the loop contains only one condition block and the i var will never get incremented unless nothing gets deleted..
-            # Note: Deleting an item from an array mutates the existing array.
-            i = 0
-            while i < len(anchorLinks):
-                if (\
-                     re.match("https://app.diagrams.net", anchorLinks[i]) \
-                     or re.match("https://app.getpostman.com/run-collection", anchorLinks[i]) \
-                     or re.match("https://learning.postman.com/", anchorLinks[i]) \
-                     or re.match("https://viewer.diagrams.net", anchorLinks[i]) \
-                     or re.search("/misc/satisfaction-levels", anchorLinks[i]) \
-                     or len(anchorLinks[i]) > 2048 \
-                    ):
-                    del anchorLinks[i]
-                else:
-                    # And while we're at it, if the link isn't deleted:
-                    #     Check for absolute links within the domain. (start with the domain instead of just slash). If found, save it to the 'wasAbsorel' array. We'll warn about them later.
-                    #     Prepend domain-relative links with the 'domain' to make them absolute for further use.
-                    #     Prepend relative anchor links that lead to 1-N levels up with the current URL so that they don't appear to be in-page anchor links.
-                    if re.match(domain, anchorLinks[i]):
-                        if not URL in wasAbsorel:
-                            wasAbsorel[URL] = []
-                        wasAbsorel[URL].append(anchorLinks[i])
-                        absorel += 1
-                    anchorLinks[i] = re.sub(rf'^/', domain + '/', anchorLinks[i])
-                    if re.match("../", anchorLinks[i]):
-                        if not URL.endswith('/'):
-                            URL = URL + '/'
-                        anchorLinks[i] = re.sub(rf'^../', URL + '../', anchorLinks[i])
-                    i += 1
-
-            # Assign cleaned anchor links to the main DB
-            pagesLinksAndAnchors[URL]['anchor-links'] = anchorLinks
+            # Note: The kept links are collected into a new list in one pass. (Deleting items from the list one by one shifts the rest of the list on every deletion.)
+            anchorLinks = [anchorLink for anchorLink in anchorLinks if len(anchorLink) <= 2048 and not anchorLink.startswith(anchorBlacklistPrefixes) and anchorBlacklistPart not in anchorLink]
+
+            # Then, for the kept links:
+            #     Check for absolute links within the domain. (start with the domain instead of just slash). If found, save it to the 'wasAbsorel' set. We'll warn about them later.
+            #     Prepend domain-relative links with the 'domain' to make them absolute for further use.
+            #     Resolve relative anchor links that lead to 1-N levels up against the current URL (see the normal links above).
+            for i, anchorLink in enumerate(anchorLinks):
+                if anchorLink.startswith(domain):
+                    wasAbsorel[URL].add(anchorLink)
+                    absorel += 1
+                if anchorLink.startswith('/'):
+                    anchorLinks[i] = domain + anchorLink
+                elif anchorLink.startswith('../'):
+                    anchorLinks[i] = urljoin(baseURL, anchorLink)
+
+            # Deduplicate the cleaned anchor links (see the normal links above)
+            anchorLinks = tuple(dict.fromkeys(anchorLinks))
 
             # Get HTML ID attributes in the document
             # name attribute works the same as id even though it's obsolete in HTML5
-            anchors = re.findall(rf'\b(?:name|id)="(.*?)"', document)
+            anchors = findAttrValues(anchorAttrRegex, document)
             # names = re.findall(rf'name="(.*?)"', document)
             # anchors += names
-            pagesLinksAndAnchors[URL]['anchors'] = anchors
+            # The anchors are only ever tested for membership, so they're stored as a set (O(1) lookup instead of walking a list)
+            anchors = frozenset(anchors)
+
+            # Store the page record to the main DB. See details about the structure above the initiation of the dictionary
+            # The record is stored only when the whole page has been processed, so a failed page never leaves a half-filled record behind.
+            pagesLinksAndAnchors[URL] = PageRecord(title, anchorLinks, normalLinks, anchors)
+
+            # Submit the links of the page that haven't been seen in any page before for checking right away
+            for normalLink in normalLinks:
+                if normalLink not in linkCheckFutures:
+                    linkCheckFutures[normalLink] = linkCheckExecutor.submit(checkLink, normalLink)
 
             if beVerbose:
                 debugTime = printDebugTime("Getting the " + URL + " took", debugTime, startTime)
@@ -458,108 +852,145 @@ try:
     if retrieved == 0:
         firstError = printNOK(type="noSitemapMatch")
 
+    # Collect the results of all the normal links checks before going thru the pages.
+    # Link checks are independent and the time is spent waiting for the network, so the unique links are checked in parallel by a pool of threads (the session's connection pool is big enough for all of them).
+    # They've been submitted during the crawl (see the main loop), so most of them are done by now.
+    linkCheckResults = {link: linkCheckFuture.result() for link, linkCheckFuture in linkCheckFutures.items()}
+    saveLinkCache(linkCheckResults)
+
+    if beVerbose:
+        debugTime = printDebugTime("Checking " + str(len(linkCheckResults)) + " unique normal links (" + str(sum(1 for link in linkCheckResults if link in cachedOKLinks)) + " of them answered from the links cache) took", debugTime, startTime)
+
+    # Get everything the anchor links check needs from the network before going thru the pages, in parallel, so the checking loop below finds it all in the caches:
+    #     1/ Resolve the redirects of the internal base URLs that aren't in the main DB (by the link-check threads, it's only HEAD requests). The results go to redirectCache.
+    #     2/ Get the anchors of the pages outside the main DB -- the final URLs of those redirects and the external pages (unless -x is on). The results go to outsidePagesAnchors.
+    #        This is done by the crawl threads because an outside page may need to be rendered in the browser and each of those threads already has its own (see getOutsidePageAnchors()).
+    redirectBaseURLs = {}
+    outsideBaseURLs = {}
+    for pageRecord in pagesLinksAndAnchors.values():
+        for link in pageRecord.anchorLinks:
+            if link.startswith('#'):
+                continue
+            linkBaseURL = link.partition('#')[0]
+            if link.startswith(URLPath):
+                linkBaseURL = linkBaseURL.removesuffix('/')
+                if linkBaseURL not in pagesLinksAndAnchors:
+                    redirectBaseURLs[linkBaseURL] = None
+            elif noExternal == False:
+                outsideBaseURLs[linkBaseURL] = None
+    redirectCache.update(zip(redirectBaseURLs, linkCheckExecutor.map(resolveRedirect, redirectBaseURLs)))
+    linkCheckExecutor.shutdown()
+    for finalURL in redirectCache.values():
+        if finalURL is not None and finalURL not in pagesLinksAndAnchors:
+            outsideBaseURLs[finalURL] = None
+    for _ in crawlExecutor.map(getOutsidePageAnchors, outsideBaseURLs):
+        pass
+    crawlExecutor.shutdown()
+
+    if beVerbose:
+        debugTime = printDebugTime("Getting " + str(len(redirectBaseURLs)) + " redirects and " + str(len(outsideBaseURLs)) + " outside pages took", debugTime, startTime)
+
     # Now, we go thru each page (URL) we got in the main DB and for each page:
     #     1/ Check if the anchor links inside it are valid
     #     2/ Check if the normal links inside it are valid
-    # `page` here means URL
-    for page in pagesLinksAndAnchors:
-        
+    # `page` here means URL, `pageRecord` is its record in the main DB
+    for page, pageRecord in pagesLinksAndAnchors.items():
+
+        # The page's anchors are looked up for every in-page anchor link, keep them in a local variable
+        pageAnchors = pageRecord.anchors
+
         # This is indicator whether we're printing the 1st error for the current page. If yes, then print the page title and URL. If not, don't print that, just print the error.
         firstError = True
 
         # We want to report broken (normal) links only once per page, even if there more of their instances -> this is a DB of NOK links within the page
-        nokLinkMultiCheck = []
+        nokLinkMultiCheck = set()
 
         # Check anchor links within the current page
-        for link in pagesLinksAndAnchors[page]["anchor-links"]:
+        for link in pageRecord.anchorLinks:
 
             # NOT USED Inform user the link is absolute even though it's within the domain
-            # try:
-            #     if link in wasAbsorel[page]:
-            #         firstError = printNOK(page, link, firstError, "absorel")
-            # except:
-            #     # It isn't. Nothing to report.
-            #     pass
+            # if link in wasAbsorel.get(page, ()):
+            #     firstError = printNOK(page, link, firstError, "absorel")
 
             # If the link is an in-page anchor link
-            if re.match('#', link):
-                if link.replace("#", "") in pagesLinksAndAnchors[page]["anchors"]:
+            if link.startswith('#'):
+                if link[1:] in pageAnchors:
                     okInPage += 1
                 else:
                     firstError = printNOK(page, link, firstError)
                     nokInPage += 1
 
             # If the link is an anchor link to another page inside the portal
-            elif re.match(f'{URLPath}', link):
+            elif link.startswith(URLPath):
                 # Split the link to the base link and the anchor by the hash character. 
                 # Also remove potential trailing slash between the base URL and the anchor
-                linkBaseURL = re.search(fr'(.*?)/?#', link).group(1)
-                linkAnchor = re.search(fr'#(.*)', link).group(1)
+                linkBaseURL, _, linkAnchor = link.partition('#')
+                linkBaseURL = linkBaseURL.removesuffix('/')
 
                 # See if we have the link in the internal DB; if yes, see if the anchor is in the target page
                 if linkBaseURL in pagesLinksAndAnchors:
-                    if linkAnchor in pagesLinksAndAnchors[linkBaseURL]['anchors']:
+                    if linkAnchor in pagesLinksAndAnchors[linkBaseURL].anchors:
                         okInternal += 1
                     else:
                         firstError = printNOK(page, link, firstError)
                         nokInternal += 1
 
                 # The link may either be a redirect or it's outside the scope of the `folder` (-f switch) and, thus, not in the pagesLinksAndAnchors DB. We need to get it.
-                # requests.get() gets history with return HTTP codes, .url contains the final landing URL. Requires import requests
+                # sessionForRequests.head() follows the redirects, .url contains the final landing URL (HEAD is enough for that, no body is downloaded). Using the session (and not bare requests.get()) reuses the pooled connection to the portal.
+                # Many links lead to the same redirected page (with different anchors), so the final URLs are cached in redirectCache. (They've all been resolved in parallel before going thru the pages, see above.)
                 else:
-                    finalURL = requests.get(linkBaseURL).url
-                    # time.sleep(1)
+                    if linkBaseURL not in redirectCache:
+                        redirectCache[linkBaseURL] = resolveRedirect(linkBaseURL)
+                    finalURL = redirectCache[linkBaseURL]
+
+                    if finalURL is None:
+                        firstError = printNOK(page, link, firstError, "normalLinkUnresolved", "", "unknown")
+                        unreachable += 1
+                        continue
 
                     # See if the final URL is in the internal DB.
                     if finalURL in pagesLinksAndAnchors:
-                        if linkAnchor in pagesLinksAndAnchors[finalURL]['anchors']:
+                        if linkAnchor in pagesLinksAndAnchors[finalURL].anchors:
                             okInternal += 1
                         else:
                             firstError = printNOK(page, link, firstError, None, finalURL)
                             nokInternal += 1
                     # This branch means that the page is outside the scope of the search (combination of `--domain` and `--folder`) or that the sitemap is incomplete or that Njord has a bug
                     else:
-                        try:
-                            browser.get(finalURL)
-                            outscopePage = browser.page_source
-                            if re.search(rf'\b(?:name|id)="{linkAnchor}"', outscopePage):
-                                okInternal += 1
-                            else:
-                                nokInternal += 1
-                        except:
-                            firstError = printNOK("", URL, firstError, "internalSitemap404")
+                        outscopeAnchors = getOutsidePageAnchors(finalURL)
+                        if outscopeAnchors is None:
+                            firstError = printNOK(page, link, firstError, "internalSitemap404")
                             notInSitemap += 1
+                        elif linkAnchor in outscopeAnchors:
+                            okInternal += 1
+                        else:
+                            nokInternal += 1
 
             # The link leads outside the (sub)portal.
             # Let's download the page and see if the anchor exists in the target page (but only if user didn't prohibit this by the -x switch).
             else:
                 if noExternal == False:
-                    # Try whether the page exists, if it does, test it. Otherwise, assume 404 or other error killed the try block. We don't care, it's simply unreachable.
-                    try:
-                        # Get the outside page
-                        browser.get(link)
-                        outsidePage = browser.page_source
-
-                        # Get base URL and anchor from the link
-                        outsideLinkBaseURL = re.search(r'(.*?)#', link).group(1)
-                        outsideLinkAnchor = re.search(r'#(.*)', link).group(1)
-                        
-                        # Try the normal anchor system - anchors go to IDs in HTML
-                        # if re.search(rf'id="{outsideLinkAnchor}"', outsidePage) or re.search(rf'name="{outsideLinkAnchor}"', outsidePage):
-                        if re.search(rf'\b(?:name|id)="{outsideLinkAnchor}"', outsidePage):
-                            # print("ZKOUSKA - matched id/name: " + link + " -- " + outsideLinkAnchor)
-                            okAnchorOutside += 1
-
-                        # Anchor not found. The anchor is either some 3rd-party atrocity, or broken.
-                        # (But it's external so we don't treat it as an error, because it might be some of those 3rd-party ... behavioral issues.)
-                        else:
-                            firstError = printNOK(page, link, firstError, "externalNOK")
-                            nokAnchorOutside += 1
-                    # Apparently the page doesn't exist (other possible issues can be 403, 500 or other codes >399, we don't really care what exactly it is)
-                    except:
-                        firstError = printNOK(page, link, firstError, ">399")
+                    # Get base URL and anchor from the link
+                    outsideLinkBaseURL, _, outsideLinkAnchor = link.partition('#')
+
+                    # Get anchors of the outside page (each outside page is downloaded only once, see getOutsidePageAnchors()).
+                    outsideAnchors = getOutsidePageAnchors(outsideLinkBaseURL)
+
+                    # Apparently the page doesn't exist (404/410, or it couldn't be got at all -- a dead host, a timeout, a malformed URL, ... see getOutsidePageAnchors(), we don't really care what exactly it is)
+                    if outsideAnchors is None:
+                        firstError = printNOK(page, link, firstError, "404")
                         unreachable += 1
 
+                    # Try the normal anchor system - anchors go to IDs (or names) in HTML
+                    elif outsideLinkAnchor in outsideAnchors:
+                        okAnchorOutside += 1
+
+                    # Anchor not found. The anchor is either some 3rd-party atrocity, or broken.
+                    # (But it's external so we don't treat it as an error, because it might be some of those 3rd-party ... behavioral issues.)
+                    else:
+                        firstError = printNOK(page, link, firstError, "externalNOK")
+                        nokAnchorOutside += 1
+
                 # We've been prohibited from going outside the domain+folder -> inform only that we can't check the page.
                 else:
                     firstError = printNOK(page, link, firstError, "cantGoOutside")
@@ -568,101 +999,49 @@ try:
             debugTime = printDebugTime("Processing anchor links for " + page + " took", debugTime, startTime)
 
         # Check normal (non-anchor) links within the current page
-        for link in pagesLinksAndAnchors[page]["normal-links"]:
-
-            # If the link is relative, add the domain to it to make it absolute including the protocol.
-            if re.match(r'^/', link):
-                link = domain + link
-
-            # Remove some links from the testing:
-            #    Fonts (local and those on cdnfonts, because CDNFonts returns 403 even if the URL is valid)
-            #    Random example / showcase domains or parts of URLs
-            #   Azure throws requests into exception block
-            #    Codepen.io blocks Requests entirely with 403
-            #     Zapier.com is OK with headless Firefox but refuses requests library, Twitter throws 400 to requests, Adobe 403
-            #    Cloudflare refuses everything, possible solution is another webdriver: https://stackoverflow.com/questions/68289474/selenium-headless-how-to-bypass-cloudflare-detection-using-selenium
-            #    https://business.adobe.com times out on bots (it looks for more than just a user agent, similar to Zapier or Cloudflare).
-            #    '%7B' is URL-encoded curly bracket '{' -- can be used in example URLs to encapsulate variables ('{var}')
-            # Note about speed (from fastest to slowest): re.match('') > re.match(r'') > re.search('') > re.search(r'')
-            #    It seems they're all regex because I need to escape question marks even if I don't add the `r` prefix.
-            if not ( \
-                       re.match('http://docs.oasis-open.org/xliff/xliff-core', link) \
-                    or re.match('https://azure.microsoft.com/en-us', link) \
-                    or re.match('https://business.adobe.com/products/target', link) \
-                    or re.match('https://csrc.nist.gov/Projects/key-management/key-management-guidelines', link) \
-                    or re.match('https://github.com/Evolveum/docs/blob/', link) \
-                    or re.match('https://graphiql-online.com/', link) \
-                    or re.match('https://help.zapier.com/hc/en-us/articles', link) \
-                    or re.match('https://player.vimeo.com/video/', link) \
-                    or re.match('https://twitter.com', link) \
-                    or re.match('https://www.cloudflare.com/learning', link) \
-                    or re.match('https://www.dta.gov.au/', link) \
-                    or re.match('https://www.mozilla.org/firefox', link) \
-                    or re.match('https://www.vic.gov.au/', link) \
-                    or re.match('mailto:', link) \
-                    or re.match(r'https?://127.0.0.1', link) \
-                    or re.match(r'https?://fonts.cdnfonts.com/css', link) \
-                    or re.match(r'https?://localhost', link) \
-                    or re.search('%7B', link) \
-                    or re.search('example.com', link) \
-                    or re.search('example.org', link) \
-                    or re.search('file-name', link) \
-                    or re.search('file_name', link) \
-                    or re.search('filename', link) \
-                    or re.search(r'woff2?$', link) \
-                ):
-
-                # Avoid loading the same links again and again (e.g., headers, navigation, footers, ...)
-                # If the link leads to the docs.e.c. AND has been checked before AND was NOK, 
-                #     let's check it again because the web app may be unreliable and one fail doesn't mean the page is truly down (and it's fairly cheap to do this).
-                #     The control var for this check is shallWeCheckThis (because you can't base a condition on an array element if you're not sure the element exists).
-                # We also need a DB of links that are checked multiple times within the current page (nokLinkMultiCheck) to avoid reporting one bad link multiple times in a single page
-
-                # Default value
-                shallWeCheckThis = "nope"
-
-                # We checked this link before
-                if link in checkedLinks:
-                    if checkedLinks[link]['status'] == "OK":
-                        okNormalLinks += 1
-                    else:
-                        unreachable += 1
-
-                # We didn't see this link before
+        # (The links are absolute and the skipped ones have been dropped already, see the main loop.)
+        for link in pageRecord.normalLinks:
+
+            # Avoid loading the same links again and again (e.g., headers, navigation, footers, ...)
+            # If the link leads to the docs.e.c. AND has been checked before AND was NOK, 
+            #     let's check it again because the web app may be unreliable and one fail doesn't mean the page is truly down (and it's fairly cheap to do this).
+            #     The control var for this check is shallWeCheckThis (because you can't base a condition on an array element if you're not sure the element exists).
+            # We also need a DB of links that are checked multiple times within the current page (nokLinkMultiCheck) to avoid reporting one bad link multiple times in a single page
+
+            # Default value
+            shallWeCheckThis = False
+
+            # We checked this link before
+            if link in checkedLinksStatus:
+                if checkedLinksStatus[link] == "OK":
+                    okNormalLinks += 1
                 else:
-                    shallWeCheckThis = "VShellPower"
+                    unreachable += 1
 
-                    # Initialize the entry for the current link in the checked links DB
-                    checkedLinks[link] = {}
-
-                if shallWeCheckThis == "VShellPower":
-                    # Try to get the link and its response code
-                    # The except block is for the portals that block direct HTTP requests
-                    try:
-                        req = sessionForRequests.get(link, timeout=10)
-                        # if re.match('https://docs.evolveum.com', link):
-                        #    time.sleep(2)
-                        checkedLinks[link]['code'] = req.status_code
-                        if req.status_code < 400:
-                            checkedLinks[link]['status'] = "OK"
-                            okNormalLinks += 1
-                        else:
-                            checkedLinks[link]['status'] = "NOK"
-                            unreachable += 1
-                            if link not in nokLinkMultiCheck:
-                                nokLinkMultiCheck.append(link)
-                                firstError = printNOK(page, link, firstError, "normalLinkUnreachable", "", checkedLinks[link]['code'])
-                    except:
-                        checkedLinks[link]['status'] = "NOK"
-                        checkedLinks[link]['code'] = "unknown" # We don't know the code because the request got blocked altogether
-                        unreachable += 1
-                        if link not in nokLinkMultiCheck:
-                            nokLinkMultiCheck.append(link)
-                            firstError = printNOK(page, link, firstError, "normalLinkUnresolved", "", checkedLinks[link]['code'])
+            # We didn't see this link before
+            else:
+                shallWeCheckThis = True
+
+            if shallWeCheckThis:
+                # The link has already been checked (in parallel with all the other links, see checkLink()) before going thru the pages. Take the result over to the checked links DB and report it.
+                # The result is bound to locals, so the DB isn't looked up again for each test.
+                linkStatus, linkCode = linkCheckResults[link]
+                checkedLinksStatus[link] = linkStatus
+                checkedLinksCode[link] = linkCode
+                if linkStatus == "OK":
+                    okNormalLinks += 1
                 else:
-                    # Getting into this branch means that the link's already been checked and it was either OK, or it's an external NOK.
-                    # Stats counting has been done in the control variable-setting condition block -> we can pass this branch.
-                    pass
+                    unreachable += 1
+                    if link not in nokLinkMultiCheck:
+                        nokLinkMultiCheck.add(link)
+                        if linkCode == "unknown":
+                            firstError = printNOK(page, link, firstError, "normalLinkUnresolved", "", linkCode)
+                        else:
+                            firstError = printNOK(page, link, firstError, "normalLinkUnreachable", "", linkCode)
+            else:
+                # Getting into this branch means that the link's already been checked and it was either OK, or it's an external NOK.
+                # Stats counting has been done in the control variable-setting condition block -> we can pass this branch.
+                pass
 
         if beVerbose:
             debugTime = printDebugTime("Processing normal links for " + page + " took", debugTime, startTime)        
@@ -671,19 +1050,30 @@ try:
         pagesChecked += 1
 
     # Finished, close temporary headless Firefox and print statistics.
-    finishAndQuit(exitCode, browser)
+    finishAndQuit(exitCode)
     
 except Exception:
-    print("Error occured or interuption code (^C) caught, terminating now.")
+    # (Ctrl-C doesn't get here, it's handled by interruptHandler().)
+    print("Error occured, terminating now.")
     exitCode = 1
     print("The exception:")
     traceback.print_exc()
-    print("Last processed page URL from the sitemap:")
-    print(URL)
+    if URL:
+        print("Last processed page URL from the sitemap:")
+        print(URL)
     if page:
         print("Last processed page URL in the main DB:")
         print(page)
     if link:
         print("Last processed anchor or normal link:")
         print(link)
-    finishAndQuit(exitCode, browser)
+    finishAndQuit(exitCode)
+
+finally:
+    # However the main block ends (finished, failed or exited by finishAndQuit()), leave nothing running:
+    #     Cancel the page downloads and link checks that haven't started yet. Otherwise, the interpreter would wait for all of them before exiting.
+    #     Close the browsers (if finishAndQuit() didn't). After that, the workers still running can't start new ones (see getBrowser()).
+    for executor in (crawlExecutor, linkCheckExecutor):
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+    closeBrowsers()